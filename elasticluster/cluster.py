@@ -18,16 +18,21 @@
 __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>, Antonio Messina <antonio.s.messina@gmail.com>'
 
 # System imports
-import operator
+import heapq
+import itertools
 import os
+import random
 import re
-import signal
 import socket
 import sys
+import threading
 import time
-from multiprocessing.dummy import Pool
+import weakref
+from contextlib import contextmanager
 
 # External modules
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, \
+    FIRST_COMPLETED
 import paramiko
 from binascii import hexlify
 
@@ -37,12 +42,165 @@ from elasticluster.exceptions import TimeoutError, NodeNotFound, \
     InstanceError, ClusterError
 from elasticluster.repository import MemRepository
 
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library
+    from time import time as _monotonic
+
+
+def _resolve_path(path):
+    """Returns the absolute path of `path`, after expanding environment
+    variables and `~`.
+    """
+    return os.path.realpath(os.path.expanduser(os.path.expandvars(path)))
+
+
+def _tcp_probe(host, port=22, timeout=None, banner=None):
+    """Checks if a TCP connection to `host` on `port` can be opened. If
+    `banner` is given, the server must also greet with a line starting with
+    it, e.g. `b'SSH-'` for an ssh server.
+
+    :return: bool - True if the connection succeeded, False otherwise
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except socket.error:
+        return False
+    try:
+        if banner:
+            greeting = b''
+            while len(greeting) < len(banner):
+                data = sock.recv(len(banner) - len(greeting))
+                if not data:
+                    break
+                greeting += data
+            return greeting == banner
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+# node kinds are used to build hostnames
+_KIND_RE = re.compile(r'^[a-zA-Z0-9-]+$')
+
+
 class IgnorePolicy(paramiko.MissingHostKeyPolicy):
     def missing_host_key(self, client, hostname, key):
         log.info('Ignoring unknown %s host key for %s: %s' %
                  (key.get_name(), hostname, hexlify(key.get_fingerprint())))
 
 
+class SSHConnectionPool(object):
+    """Thread-safe pool of ssh connections, so that an ssh connection to a
+    node can be reused instead of doing the whole handshake again. The
+    connections are kept per `(host, username, key_filename)`.
+
+    Connections are taken from the pool with :py:meth:`get` and given back
+    with :py:meth:`release`, or by using :py:meth:`checkout` as a context
+    manager. Idle connections are dropped after `idle_timeout` seconds, and
+    at most `max_idle` idle connections are kept for each host.
+    """
+    idle_timeout = 60 * 5  #: seconds after which idle connections are closed
+    max_idle = 4  #: maximum number of idle connections kept for each host
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # [(host, username, key_filename)] = [(client, release time)]
+        self._idle = dict()
+        # remember where a connection goes to, in order to release it
+        self._keys = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _is_active(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, host, username, key_filename, timeout=None,
+            allow_agent=True):
+        """Returns an open ssh connection, either an idle one from the pool
+        or a new one. New connections authenticate with `key_filename`, and
+        then with the keys of the ssh agent if `allow_agent` is true; the
+        keys in `~/.ssh` are never looked for.
+
+        :return: :py:class:`paramiko.SSHClient`
+        :raises: `socket.error` or `paramiko.SSHException` if a new
+                 connection cannot be opened
+        """
+        key = (host, username, key_filename)
+        while True:
+            with self._lock:
+                if not self._idle.get(key):
+                    break
+                client, released = self._idle[key].pop()
+            if _monotonic() - released < self.idle_timeout \
+                    and self._is_active(client):
+                return client
+            client.close()
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(IgnorePolicy())
+        client.connect(host,
+                       username=username,
+                       allow_agent=allow_agent,
+                       look_for_keys=False,
+                       key_filename=key_filename,
+                       timeout=timeout)
+        with self._lock:
+            self._keys[client] = key
+        return client
+
+    def release(self, client):
+        """Gives back a connection obtained from :py:meth:`get` to the pool.
+        The connection is closed if it is not active anymore or if the pool
+        is full.
+        """
+        with self._lock:
+            key = self._keys.get(client)
+        if key is not None and self._is_active(client):
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append((client, _monotonic()))
+                    return
+        client.close()
+
+    @contextmanager
+    def checkout(self, host, username, key_filename, timeout=None,
+                 allow_agent=True):
+        """Context manager version of :py:meth:`get` and :py:meth:`release`.
+        """
+        client = self.get(host, username, key_filename, timeout=timeout,
+                          allow_agent=allow_agent)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+
+ssh_pool = SSHConnectionPool()  #: ssh connections shared by all the nodes
+
+
+def _close_connection(future):
+    """Closes the ssh connection returned by `future`, if any.
+    """
+    try:
+        ssh = future.result()
+    except Exception as ex:
+        log.debug("Ignoring error from an unused ssh connection: %s", ex)
+        return
+    if ssh:
+        ssh.close()
+
+
 class Cluster(object):
     """This is the heart of elasticluster and handles all cluster relevant
     behavior. You can basically start, setup and stop a cluster. Also it
@@ -65,9 +223,12 @@ class Cluster(object):
 
     :param str user_key_name: name of the ssh key to connect to cloud
 
-    :param str user_key_public: path to ssh public key file
+    :param str user_key_public: path to ssh public key file; environment
+                                variables and `~` are expanded, and the
+                                path is stored as absolute path
 
-    :param str user_key_private: path to ssh private key file
+    :param str user_key_private: path to ssh private key file; same as
+                                 `user_key_public`
 
     :param repository: by default the
                        :py:class:`elasticluster.repository.MemRepository` is
@@ -82,6 +243,9 @@ class Cluster(object):
                  nodes in this cluster
    """
     startup_timeout = 60 * 10  #: timeout in seconds to start all nodes
+    thread_pool_max_size = 32  #: maximum number of threads talking to the cloud
+    poll_delay_min = 2  #: initial delay in seconds between two node probes
+    poll_delay_max = 30  #: maximum delay in seconds between two node probes
 
     def __init__(self, name, cloud_provider, setup_provider,
                  user_key_name, user_key_public,
@@ -90,20 +254,13 @@ class Cluster(object):
         self._cloud_provider = cloud_provider
         self._setup_provider = setup_provider
         self._user_key_name = user_key_name
-        self._user_key_public = user_key_public
-        self.user_key_private = user_key_private
+        self._user_key_public = _resolve_path(user_key_public)
+        self.user_key_private = _resolve_path(user_key_private)
         self.repository = repository if repository else MemRepository()
         self.ssh_to = extra.get('ssh_to')
         self.extra = extra.copy()
         self.nodes = dict()
 
-        self.user_key_private = os.path.expandvars(self.user_key_private)
-        self.user_key_private = os.path.expanduser(self.user_key_private)
-
-        self._user_key_public = os.path.expanduser(self._user_key_public)
-        self._user_key_public = os.path.expandvars(self._user_key_public)
-
-
     def add_node(self, kind, image_id, image_user, flavor,
                  security_group, image_userdata='', name=None):
         """Adds a new node to the cluster. This factory method provides an
@@ -137,13 +294,17 @@ class Cluster(object):
         :return: created :py:class:`Node`
 
         """
-        if not re.match("^[a-zA-Z0-9-]+$", kind):
-            raise ValueError(
-                "Invalid name `%s`. The `kind` argument may only contains "
-                "characters in [a-z0-9-] range, as it is going to be used as "
-                "hostname" % kind
-            )
+        self._check_kind(kind)
+        return self._add_node(kind, image_id, image_user, flavor,
+                              security_group, image_userdata, name)
 
+    def _add_node(self, kind, image_id, image_user, flavor,
+                  security_group, image_userdata, name):
+        """Adds a new node to the cluster, like :py:meth:`add_node`, but
+        without checking `kind`.
+
+        :return: created :py:class:`Node`
+        """
         if kind not in self.nodes:
             self.nodes[kind] = []
 
@@ -179,10 +340,26 @@ class Cluster(object):
                                    to the instance
 
         :param str image_userdata: commands to execute after instance starts
+
+        :raises: ValueError: `kind` argument is an invalid string.
         """
+        self._check_kind(kind)
         for i in range(num):
-            self.add_node(kind, image_id, image_user, flavor,
-                          security_group, image_userdata=image_userdata)
+            self._add_node(kind, image_id, image_user, flavor,
+                           security_group, image_userdata, None)
+
+    @staticmethod
+    def _check_kind(kind):
+        """Static method to check that `kind` can be used as node kind.
+
+        :raises: ValueError: `kind` argument is an invalid string.
+        """
+        if not _KIND_RE.match(kind):
+            raise ValueError(
+                "Invalid name `%s`. The `kind` argument may only contains "
+                "characters in [a-z0-9-] range, as it is going to be used as "
+                "hostname" % kind
+            )
 
     def remove_node(self, node):
         """Removes a node from the cluster, but does not stop it. Use this
@@ -195,9 +372,29 @@ class Cluster(object):
             log.error("Unable to remove node %s: invalid node type `%s`.",
                       node.name, node.kind)
         else:
-            index = self.nodes[node.kind].index(node)
-            if self.nodes[node.kind][index]:
-                del self.nodes[node.kind][index]
+            self.nodes[node.kind].remove(node)
+
+    def _remove_nodes(self, nodes):
+        """Removes several nodes from the cluster, but does not stop them.
+        Unlike calling :py:meth:`remove_node` on each node, this scans each
+        node group only once.
+
+        :param nodes: nodes to remove
+        :type nodes: list of :py:class:`Node`
+        """
+        to_remove = set(nodes)
+        for group in self.nodes.values():
+            group[:] = [node for node in group if node not in to_remove]
+
+    def _make_thread_pool(self, num_tasks):
+        """Creates a pool of threads to run `num_tasks` tasks concurrently.
+        The pool never holds more than `thread_pool_max_size` threads.
+
+        :return: :py:class:`concurrent.futures.ThreadPoolExecutor`
+        """
+        workers = max(1, min(self.thread_pool_max_size, num_tasks))
+        log.debug("Created pool of %d threads", workers)
+        return ThreadPoolExecutor(max_workers=workers)
 
     @staticmethod
     def _start_node(node):
@@ -205,7 +402,7 @@ class Cluster(object):
 
         :return: bool -- True on success, False otherwise
         """
-        log.debug("_start_node: working on node %s" % node.name)
+        log.debug("_start_node: working on node %s", node.name)
         # TODO: the following check is not optimal yet. When a
         # node is still in a starting state,
         # it will start another node here,
@@ -222,18 +419,186 @@ class Cluster(object):
                 return True
             except Exception as e:
                 log.error("could not start node `%s` for reason "
-                          "`%s`" % (node.name, e))
+                          "`%s`", node.name, e)
                 return None
 
+    @staticmethod
+    def _probe_ssh(node):
+        """Static method to check if we can log in to a node via ssh. The
+        cheap check of the ssh greeting is done first, and only then a
+        login is tried.
+
+        :return: bool -- True on success, False otherwise
+        """
+        if not node.is_ssh_port_open():
+            return False
+        # the ssh server may answer before the keys of the user are
+        # installed on the node: it is only ready once we can log in
+        ssh = node.connect()
+        if not ssh:
+            log.debug("Node %s answers on the ssh port, but we cannot "
+                      "log in yet.", node.name)
+            return False
+        ssh_pool.release(ssh)
+        log.info("Node %s (%s) is accepting ssh connections.",
+                 node.name, node.connection_ip())
+        return True
+
+    def _wait_for_nodes(self, thread_pool, pending_nodes, probe, deadline):
+        """Waits until `probe` succeeds on all the given nodes. Each node is
+        probed independently of the others: a node is removed from
+        `pending_nodes` as soon as its probe succeeds, while a failed probe
+        is submitted again after a delay. The delay starts at
+        `poll_delay_min` seconds and doubles after each failure up to
+        `poll_delay_max`, with some random jitter so that the nodes do not
+        hit the cloud provider all at the same time.
+
+        :param thread_pool: pool of threads to run the probes in
+        :type thread_pool: :py:class:`concurrent.futures.ThreadPoolExecutor`
+        :param list pending_nodes: nodes to wait for; this list is modified
+                                   in place, so that it always holds the
+                                   nodes still pending
+        :param probe: function called with a node, returning a bool
+        :param float deadline: time, as returned by a monotonic clock, at
+                               which to stop waiting
+        :raises: TimeoutError if some probes did not succeed before
+                 `deadline`
+        """
+        running = dict((thread_pool.submit(probe, node), node)
+                       for node in pending_nodes)
+        delays = dict((node, self.poll_delay_min) for node in pending_nodes)
+        # heap of (time, sequence number, node) for the failed probes; the
+        # sequence number avoids comparing nodes when times are equal
+        scheduled = []
+        sequence = itertools.count()
+        while running or scheduled:
+            now = _monotonic()
+            if now >= deadline:
+                raise TimeoutError("timeout reached while waiting for nodes "
+                                   "%s" % str.join(', ', [node.name for node
+                                                          in pending_nodes]))
+            while scheduled and scheduled[0][0] <= now:
+                node = heapq.heappop(scheduled)[2]
+                running[thread_pool.submit(probe, node)] = node
+            if scheduled:
+                timeout = min(scheduled[0][0], deadline) - now
+            else:
+                timeout = deadline - now
+            if not running:
+                # `wait()` returns at once on no futures: sleep instead
+                # until the next probe is due
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                if future.result():
+                    pending_nodes.remove(node)
+                    continue
+                delay = delays[node] * random.uniform(0.75, 1.25)
+                delays[node] = min(2 * delays[node], self.poll_delay_max)
+                heapq.heappush(scheduled,
+                               (_monotonic() + delay, next(sequence), node))
+
+    def _get_running_instances(self, nodes):
+        """Asks the cloud provider for the state of all the given nodes with
+        a single request.
+
+        :param list nodes: nodes to check
+        :return: dict [instance_id] = bool - True if running, False
+                 otherwise; None if the request failed
+        :raises: NotImplementedError if the cloud provider can only check
+                 one instance at a time
+        """
+        instance_ids = list(set(node.instance_id for node in nodes
+                                if node.instance_id))
+        if not instance_ids:
+            return {}
+        try:
+            return self._cloud_provider.are_instances_running(instance_ids)
+        except NotImplementedError:
+            raise
+        except Exception as ex:
+            # e.g. a single unknown id makes EC2 reject the whole request
+            log.debug("Error while looking for vm ids %s: %s",
+                      str.join(', ', instance_ids), str(ex))
+            return None
+
+    def _refresh_all_nodes(self, thread_pool, nodes):
+        """Asks the cloud provider for the state of all the given nodes with
+        a single request, and updates the IP addresses of the running ones.
+        If that request fails, each node is checked on its own with
+        :py:meth:`Node.is_alive`.
+
+        :param thread_pool: pool of threads to update the IP addresses in
+        :type thread_pool: :py:class:`concurrent.futures.ThreadPoolExecutor`
+        :param list nodes: nodes to check
+        :return: list of the running nodes
+        :raises: NotImplementedError if the cloud provider can only check
+                 one instance at a time
+        """
+        running = self._get_running_instances(nodes)
+        if running is None:
+            # check each node on its own for this round
+            alive = thread_pool.map(Node.is_alive, nodes)
+            return [node for node, ok in zip(nodes, alive) if ok]
+
+        running_nodes = [node for node in nodes
+                         if running.get(node.instance_id)]
+        list(thread_pool.map(Node.update_ips, running_nodes))
+        return running_nodes
+
+    def _wait_for_running_nodes(self, thread_pool, pending_nodes, deadline):
+        """Waits until all the given nodes are up and running on the cloud.
+        The state of all the nodes is fetched with a single request to the
+        cloud provider, if it supports that; otherwise each node is checked
+        on its own with :py:meth:`Node.is_alive`. Requests are spaced out
+        like in :py:meth:`_wait_for_nodes`.
+
+        :param thread_pool: pool of threads to run the requests in
+        :type thread_pool: :py:class:`concurrent.futures.ThreadPoolExecutor`
+        :param list pending_nodes: nodes to wait for; this list is modified
+                                   in place, so that it always holds the
+                                   nodes still pending
+        :param float deadline: time, as returned by a monotonic clock, at
+                               which to stop waiting
+        :raises: TimeoutError if some nodes are not running by `deadline`
+        """
+        delay = self.poll_delay_min
+        while True:
+            try:
+                running_nodes = self._refresh_all_nodes(thread_pool,
+                                                        pending_nodes)
+            except NotImplementedError:
+                self._wait_for_nodes(thread_pool, pending_nodes,
+                                     Node.is_alive, deadline)
+                return
+            for node in running_nodes:
+                pending_nodes.remove(node)
+            if not pending_nodes:
+                return
+
+            now = _monotonic()
+            if now >= deadline:
+                raise TimeoutError("timeout reached while waiting for nodes "
+                                   "%s" % str.join(', ', [node.name for node
+                                                          in pending_nodes]))
+            time.sleep(min(delay * random.uniform(0.75, 1.25),
+                           deadline - now))
+            delay = min(2 * delay, self.poll_delay_max)
+
     def start(self, min_nodes=None):
         """Starts up all the instances in the cloud. To speed things up all
         instances are started in a seperate thread. To make sure
-        elasticluster is not stopped during creation of an instance, it will
-        overwrite the sigint handler. As soon as the last started instance
-        is returned and saved to the repository, sigint is executed as usual.
+        elasticluster is not stopped during creation of an instance, a
+        KeyboardInterrupt waits for the instances being created and saves
+        them to the repository before exiting.
         An instance is up and running as soon as a ssh connection can be
-        established. If the startup timeout is reached before all instances
-        are started, the cluster will stop and destroy all instances.
+        established; the cheaper check of the ssh greeting is used to poll
+        the nodes before logging in. If the startup timeout is reached
+        before all instances are started, the cluster will stop and destroy
+        all instances.
 
         This method is blocking and might take some time depending on the
         amount of instances to start.
@@ -243,130 +608,109 @@ class Cluster(object):
         :type min_nodes: dict [node_kind] = number
         """
 
-        # To not mess up the cluster management we start the nodes in a
-        # different thread. In this case the main thread receives the sigint
-        # and communicates to the `start_node` thread. The nodes to work on
-        # are passed in a managed queue.
-        self.keep_running = True
-
-        def sigint_handler(signal, frame):
-            """
-            Makes sure the cluster is stored, before the sigint results in
-            exiting during the node startup.
-            """
-            log.error("user interruption: saving cluster before exit.")
-            self.keep_running = False
-
+        # To not mess up the cluster management we start the nodes in
+        # different threads. In this case the main thread receives the
+        # KeyboardInterrupt and waits for the `start_node` threads to
+        # finish. The number of threads is capped, so that big clusters do
+        # not spawn one thread per node.
         nodes = self.get_all_nodes()
-        thread_pool = Pool(processes=len(nodes))
-        log.debug("Created pool of %d threads" % len(nodes))
-        signal.signal(signal.SIGINT, sigint_handler)
-
-        # This is blocking
-        result = thread_pool.map_async(self._start_node, nodes)
-
-        while not result.ready():
-            result.wait(1)
-            if not self.keep_running:
-                # the user did abort the start of the cluster. We finish the
-                #  current start of a node and save the status to the
-                # storage, so we don't have not managed instances laying
-                # around
-                log.error("Aborting upon Ctrl-C")
-                thread_pool.close()
-                thread_pool.join()
-                self.repository.save_or_update(self)
-                sys.exit(1)
+        thread_pool = self._make_thread_pool(len(nodes))
 
-        # dump the cluster here, so we don't loose any knowledge
-        self.repository.save_or_update(self)
-
-        signal.alarm(0)
-
-        def sigint_reset(signal, frame):
+        # This is blocking. Each thread reports on the `finished` queue, so
+        # that the main thread just waits for the next report instead of
+        # checking all the pending nodes.
+        futures = []
+        finished = queue.Queue()
+        try:
+            # submitting is inside the `try`, so that the nodes already
+            # started are saved if the user interrupts it
+            for node in nodes:
+                future = thread_pool.submit(self._start_node, node)
+                future.add_done_callback(finished.put)
+                futures.append(future)
+            pending = len(futures)
+            while pending:
+                # waiting without a timeout would not let Python 2 deliver
+                # the KeyboardInterrupt until all nodes are started
+                try:
+                    finished.get(timeout=1)
+                    pending -= 1
+                except queue.Empty:
+                    pass
+        except KeyboardInterrupt:
+            # the user did abort the start of the cluster. We finish the
+            #  current start of a node and save the status to the
+            # storage, so we don't have not managed instances laying
+            # around
+            log.error("user interruption: saving cluster before exit.")
+            for future in futures:
+                future.cancel()
+            thread_pool.shutdown(wait=True)
+            self.repository.save_or_update(self)
             sys.exit(1)
-        signal.signal(signal.SIGINT, sigint_reset)
-
-        # check if all nodes are running, stop all nodes if the
-        # timeout is reached
-        def timeout_handler(signum, frame):
-            raise TimeoutError("problems occured while starting the nodes, "
-                               "timeout `%i`", Cluster.startup_timeout)
 
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(Cluster.startup_timeout)
-
-        starting_nodes = self.get_all_nodes()
-        try:
-            while starting_nodes:
-                starting_nodes = [n for n in starting_nodes
-                                  if not n.is_alive()]
-                if starting_nodes:
-                    time.sleep(10)
-        except TimeoutError as timeout:
-            log.error("Not all nodes were started correctly within the given"
-                      " timeout `%s`" % Cluster.startup_timeout)
-            for node in starting_nodes:
-                log.error("Stopping node `%s`, since it could not start "
-                          "within the given timeout" % node.name)
-                node.stop()
-                self.remove_node(node)
-
-        signal.alarm(0)
-
-        # If we reached this point, we should have IP addresses for
-        # the nodes, so update the storage file again.
+        # dump the cluster here, so we don't loose any knowledge
         self.repository.save_or_update(self)
 
-        # Try to connect to each node. Run the setup action only when
-        # we successfully connect to all of them.
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(Cluster.startup_timeout)
-        pending_nodes = self.get_all_nodes()[:]
-
         try:
-            while pending_nodes:
-                for node in pending_nodes[:]:
-                    if node.connect():
-                        log.info("Connection to node %s (%s) successful.",
-                                 node.name, node.connection_ip())
-                        pending_nodes.remove(node)
-                if pending_nodes:
-                    time.sleep(5)
-
-        except TimeoutError:
-            # remove the pending nodes from the cluster
-            log.error("Could not connect to all the nodes of the "
-                      "cluster within the given timeout `%s`."
-                      % Cluster.startup_timeout)
-            for node in pending_nodes:
-                log.error("Stopping node `%s`, since we could not connect to"
-                          " it within the timeout." % node.name)
-                node.stop()
-                self.remove_node(node)
-
-        signal.alarm(0)
-
-        # It might be possible that the node.connect() call updated
-        # the `preferred_ip` attribute, so, let's save the cluster
-        # again.
-        self.repository.save_or_update(self)
+            # check if all nodes are running, stop all nodes if the
+            # timeout is reached
+            starting_nodes = self.get_all_nodes()
+            try:
+                self._wait_for_running_nodes(
+                    thread_pool, starting_nodes,
+                    _monotonic() + Cluster.startup_timeout)
+            except TimeoutError:
+                log.error("Not all nodes were started correctly within the "
+                          "given timeout `%s`", Cluster.startup_timeout)
+                for node in starting_nodes:
+                    log.error("Stopping node `%s`, since it could not start "
+                              "within the given timeout", node.name)
+                    node.stop()
+                self._remove_nodes(starting_nodes)
 
-        # A lot of things could go wrong when starting the cluster. To
-        # ensure a stable cluster fitting the needs of the user in terms of
-        # cluster size, we check the minimum nodes within the node groups to
-        # match the current setup.
-        if not min_nodes:
-            # the node minimum is implicit if not specified.
-            min_nodes = dict((key, len(self.nodes[key])) for key in
-                             self.nodes.iterkeys())
-        else:
-            # check that each group has a minimum value
-            for group, nodes in nodes.iteritems():
-                if group not in min_nodes:
-                    min_nodes[group] = len(nodes)
+            # Try to connect to each node. Run the setup action only when
+            # we successfully connect to all of them.
+            pending_nodes = self.get_all_nodes()
 
-        self._check_cluster_size(min_nodes)
+            try:
+                self._wait_for_nodes(thread_pool, pending_nodes,
+                                     self._probe_ssh,
+                                     _monotonic() + Cluster.startup_timeout)
+            except TimeoutError:
+                # remove the pending nodes from the cluster
+                log.error("Could not connect to all the nodes of the "
+                          "cluster within the given timeout `%s`.",
+                          Cluster.startup_timeout)
+                for node in pending_nodes:
+                    log.error("Stopping node `%s`, since we could not connect"
+                              " to it within the timeout.", node.name)
+                    node.stop()
+                self._remove_nodes(pending_nodes)
+
+            thread_pool.shutdown(wait=True)
+
+            # A lot of things could go wrong when starting the cluster. To
+            # ensure a stable cluster fitting the needs of the user in terms
+            # of cluster size, we check the minimum nodes within the node
+            # groups to match the current setup.
+            if not min_nodes:
+                # the node minimum is implicit if not specified.
+                min_nodes = dict((key, len(nodes))
+                                 for key, nodes in self.nodes.items())
+            else:
+                # check that each group has a minimum value
+                for group, nodes in self.nodes.items():
+                    if group not in min_nodes:
+                        min_nodes[group] = len(nodes)
+
+            self._check_cluster_size(min_nodes)
+        finally:
+            # The nodes got their IP addresses, `node.is_ssh_port_open()`
+            # and `node.connect()` might have updated their `preferred_ip`
+            # attribute, and nodes may have been removed or moved to other
+            # groups: save all of it at once.
+            self.repository.save_or_update(self)
 
     def _check_cluster_size(self, min_nodes):
         """Checks the size of the cluster to fit the needs of the user. It
@@ -379,12 +723,11 @@ class Cluster(object):
         :raises: ClusterError in case the size does not fit the minimum
                  number specified by the user.
         """
-        # check the total sizes before moving the nodes around
-        minimum_nodes = 0
-        for group, size in min_nodes.iteritems():
-            minimum_nodes = minimum_nodes + size
+        counts = dict((group, len(nodes))
+                      for group, nodes in self.nodes.items())
 
-        if len(self.get_all_nodes()) < minimum_nodes:
+        # check the total sizes before moving the nodes around
+        if sum(counts.values()) < sum(min_nodes.values()):
             raise ClusterError("The cluster does not provide the minimum "
                                "amount of nodes specified in the "
                                "configuration. The nodes are still running, "
@@ -393,26 +736,36 @@ class Cluster(object):
                                "configuration or try to start a new cluster "
                                "after checking the cloud provider settings.")
 
-        # finding all node groups with an unsatisfied amount of nodes
-        unsatisfied_groups = []
-        for group, size in min_nodes.iteritems():
-            if len(self.nodes[group]) < size:
-                unsatisfied_groups.append(group)
-
-        # trying to move nodes around to fill the groups with missing nodes
-        for ugroup in unsatisfied_groups[:]:
-            missing = min_nodes[ugroup] - len(self.nodes[ugroup])
-            for group, nodes in self.nodes.iteritems():
-                spare = len(self.nodes[group]) - min_nodes[group]
-                while spare > 0 and missing > 0:
-                    self.nodes[ugroup].append(self.nodes[group][-1])
-                    del self.nodes[group][-1]
-                    spare = spare - 1
-                    missing = missing - 1
-
-                    if missing == 0:
-                        unsatisfied_groups.remove(ugroup)
-
+        # nodes missing in each group with an unsatisfied amount of nodes,
+        # and nodes which can be spared by the other groups
+        need = dict((group, size - counts.get(group, 0))
+                    for group, size in min_nodes.items()
+                    if counts.get(group, 0) < size)
+        have = dict((group, count - min_nodes.get(group, 0))
+                    for group, count in counts.items()
+                    if count > min_nodes.get(group, 0))
+
+        # plan how to move the nodes around to fill the groups with missing
+        # nodes, only looking at the numbers of nodes ...
+        transfer_plan = []
+        for recipient in need:
+            for donor in have:
+                move = min(need[recipient], have[donor])
+                if move > 0:
+                    transfer_plan.append((donor, recipient, move))
+                    need[recipient] -= move
+                    have[donor] -= move
+                if not need[recipient]:
+                    break
+
+        # ... then move them
+        for donor, recipient, move in transfer_plan:
+            self.nodes.setdefault(recipient, []).extend(
+                self.nodes[donor][-move:])
+            del self.nodes[donor][-move:]
+
+        unsatisfied_groups = [group for group, missing in need.items()
+                              if missing]
         if unsatisfied_groups:
             raise ClusterError("Could not find an optimal solution to "
                                "distribute the started nodes into the node "
@@ -428,34 +781,51 @@ class Cluster(object):
 
         :return: list of :py:class:`Node`
         """
-        nodes = self.nodes.values()
-        if nodes:
-            return reduce(operator.add, nodes, list())
-        else:
-            return []
+        return list(itertools.chain.from_iterable(self.nodes.values()))
+
+    @staticmethod
+    def _stop_node(node):
+        """Static method to stop a specific node on a cloud
+
+        :return: bool -- True on success, False otherwise
+        """
+        instance_id = node.instance_id
+        try:
+            node.stop()
+            log.debug("Removed node with instance id %s from %s",
+                      instance_id, node.kind)
+            return True
+        except:
+            # Boto does not always raises an `Exception` class!
+            log.error("could not stop instance `%s`, it might "
+                      "already be down.", instance_id)
+            return False
 
     def stop(self, force=False):
         """Destroys all instances of this cluster and calls delete on the
-        repository.
+        repository. The instances are stopped concurrently.
 
         :param bool force: force termination of instances in any case
         """
+        running_nodes = []
         for node in self.get_all_nodes():
             if node.instance_id:
-                try:
-                    node.stop()
-                    self.nodes[node.kind].remove(node)
-                    log.debug("Removed node with instance id %s from %s"
-                              % (node.instance_id, node.kind))
-                except:
-                    # Boto does not always raises an `Exception` class!
-                    log.error("could not stop instance `%s`, it might "
-                              "already be down.", node.instance_id)
+                running_nodes.append(node)
             else:
                 log.debug("Not stopping node with no instance id. It seems "
-                          "like node `%s` did not start correctly."
-                          % node.name)
+                          "like node `%s` did not start correctly.",
+                          node.name)
                 self.nodes[node.kind].remove(node)
+
+        if running_nodes:
+            with self._make_thread_pool(len(running_nodes)) as thread_pool:
+                stopped = list(thread_pool.map(self._stop_node,
+                                               running_nodes))
+            # only the main thread modifies `self.nodes`
+            for node, ok in zip(running_nodes, stopped):
+                if ok:
+                    self.nodes[node.kind].remove(node)
+
         if not self.get_all_nodes():
             log.debug("Removing cluster %s.", self.name)
             self._setup_provider.cleanup(self)
@@ -512,7 +882,7 @@ class Cluster(object):
         try:
             # setup the cluster using the setup provider
             ret = self._setup_provider.setup_cluster(self)
-        except Exception, e:
+        except Exception as e:
             log.error(
                 "the setup provider was not able to setup the cluster, "
                 "but the cluster is running by now. Setup provider error "
@@ -527,17 +897,33 @@ class Cluster(object):
 
         return ret
 
+    @staticmethod
+    def _update_node(node):
+        """Static method to update the connection information of a node,
+        ignoring errors from the cloud provider.
+        """
+        try:
+            node.update_ips()
+        except InstanceError as ex:
+            log.warning("Ignoring error updating information on node %s: %s",
+                        node, str(ex))
+
     def update(self):
         """Update all connection information of the nodes of this cluster.
         It occurs for example public ip's are not available imediatly,
         therefore calling this method might help.
         """
-        for node in self.get_all_nodes():
-            try:
-                node.update_ips()
-            except InstanceError, ex:
-                log.warning("Ignoring error updating information on node %s: %s",
-                          node, str(ex))
+        nodes = self.get_all_nodes()
+        # load all the instances with a single request, so that the
+        # concurrent `get_ips` calls below find them in the cache of the
+        # cloud provider instead of all refreshing it at once
+        try:
+            self._get_running_instances(nodes)
+        except NotImplementedError:
+            pass
+        if nodes:
+            with self._make_thread_pool(len(nodes)) as thread_pool:
+                list(thread_pool.map(self._update_node, nodes))
         self.repository.save_or_update(self)
 
 
@@ -580,6 +966,10 @@ class Node(object):
     :ivar ips: list of all the IPs defined for this node.
     """
     connection_timeout = 5  #: timeout in seconds to connect to host via ssh
+    probe_timeout = 1  #: timeout in seconds to check if the ssh port is open
+    #: use the ssh agent when the private key file alone is not enough,
+    #: e.g. because it is encrypted with a password
+    ssh_allow_agent = True
 
     def __init__(self, name, kind, cloud_provider, user_key_public,
                  user_key_private, user_key_name, image_user, security_group,
@@ -642,7 +1032,7 @@ class Node(object):
                       self.instance_id)
             running = self._cloud_provider.is_instance_running(
                 self.instance_id)
-        except Exception, ex:
+        except Exception as ex:
             log.debug("Ignoring error while looking for vm id %s: %s",
                       self.instance_id, str(ex))
         if running:
@@ -662,43 +1052,104 @@ class Node(object):
         """
         return self.preferred_ip
 
+    def is_ssh_port_open(self, timeout=None):
+        """Checks if an ssh server answers on one of the IPs of the node,
+        by reading its greeting; this is much faster than opening an ssh
+        connection with :py:meth:`connect`, but does not check that we can
+        log in. The `preferred_ip` is tried first, and then set to the
+        first IP that answers.
+
+        :param float timeout: timeout in seconds for each IP, defaults to
+                              `probe_timeout`
+
+        :return: bool - True if an ssh server answered, False otherwise
+        """
+        if timeout is None:
+            timeout = Node.probe_timeout
+        candidates = itertools.chain(
+            [self.preferred_ip] if self.preferred_ip else [],
+            (ip for ip in self.ips if ip != self.preferred_ip))
+        for ip in candidates:
+            if _tcp_probe(ip, timeout=timeout, banner=b'SSH-'):
+                if ip != self.preferred_ip:
+                    log.debug("Setting `preferred_ip` to %s", ip)
+                    self.preferred_ip = ip
+                return True
+            log.debug("No ssh server answering on host %s (%s).",
+                      self.name, ip)
+        return False
+
     def connect(self):
-        """Connect to the node via ssh using the paramiko library.
+        """Connect to the node via ssh using the paramiko library. The
+        connection is taken from :py:data:`ssh_pool`, so that an idle
+        connection to this node is reused if there is one. Give it back with
+        `ssh_pool.release()` when done, or just close it.
 
         :return: :py:class:`paramiko.SSHClient` - ssh connection or None on
                  failure
         """
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(IgnorePolicy())
         # Try connecting using the `preferred_ip`, if
-        # present. Otherwise, try all of them and set `preferred_ip`
-        # using the first that is working.
-        ips=self.ips[:]
-        # This is done in order to "sort" the IPs and put the preferred_ip first.
-        if self.preferred_ip: ips.remove(self.preferred_ip)
+        # present. Otherwise, try all of them at the same time and set
+        # `preferred_ip` using the first that is working.
+        if self.preferred_ip:
+            ssh = self._connect_to(self.preferred_ip)
+            if ssh:
+                return ssh
+
+        candidates = [ip for ip in self.ips if ip != self.preferred_ip]
+        if not candidates:
+            return None
 
-        for ip in [self.preferred_ip] + ips:
+        thread_pool = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = dict((thread_pool.submit(self._connect_to, ip), ip)
+                       for ip in candidates)
+        thread_pool.shutdown(wait=False)
+        ssh = None
+        for future in as_completed(futures):
             try:
-                log.debug("Trying to connect to host %s (%s)",
-                          self.name, ip)
-                ssh.connect(ip,
-                            username=self.image_user,
-                            allow_agent=True,
-                            key_filename=self.user_key_private,
-                            timeout=Node.connection_timeout)
-                log.debug("Connection to %s succeded!", ip)
-                if ip != self.preferred_ip:
-                    log.debug("Setting `preferred_ip` to %s", ip)
-                    self.preferred_ip = ip
-                    cluster_changed = True
-                return ssh
-            except socket.error, ex:
-                log.debug("Host %s (%s) not reachable: %s.",
-                          self.name, ip, ex)
-            except paramiko.SSHException, ex:
-                log.debug("Ignoring error %s connecting to %s",
-                          str(ex), self.name)
+                ssh = future.result()
+            except Exception as ex:
+                log.debug("Ignoring error connecting to %s (%s): %s",
+                          self.name, futures[future], ex)
+                continue
+            if ssh:
+                ip = futures.pop(future)
+                log.debug("Setting `preferred_ip` to %s", ip)
+                self.preferred_ip = ip
+                break
+        # connections to the other IPs which succeed anyway would never be
+        # used, since `preferred_ip` is tried first: close them
+        for future in futures:
+            future.add_done_callback(_close_connection)
+        return ssh
+
+    def _connect_to(self, ip):
+        """Connect to the node via ssh on the given IP address.
 
+        :return: :py:class:`paramiko.SSHClient` - ssh connection or None on
+                 failure
+        """
+        # Opening a TCP connection to the ssh port is much faster than
+        # waiting for the ssh timeout on IPs which are not reachable.
+        if not _tcp_probe(ip, timeout=Node.probe_timeout):
+            log.debug("Host %s (%s) not reachable on the ssh port.",
+                      self.name, ip)
+            return None
+        try:
+            log.debug("Trying to connect to host %s (%s)",
+                      self.name, ip)
+            ssh = ssh_pool.get(ip, self.image_user,
+                               self.user_key_private,
+                               timeout=Node.connection_timeout,
+                               allow_agent=self.ssh_allow_agent)
+            log.debug("Connection to %s succeded!", ip)
+            return ssh
+        except socket.error as ex:
+            log.debug("Host %s (%s) not reachable: %s.",
+                      self.name, ip, ex)
+        except paramiko.SSHException as ex:
+            log.debug("Ignoring error %s connecting to %s",
+                      str(ex), self.name)
         return None
 
     def update_ips(self):
@@ -711,9 +1162,9 @@ class Node(object):
         return self.ips[:]
 
     def __str__(self):
-        return "name=`%s`, id=`%s`, ips=%s, "\
-            "connection_ip=`%s`" % (self.name, self.instance_id, str.join(', ', self.ips),
-                                    self.preferred_ip)
+        return "name=`%s`, id=`%s`, ips=%s, connection_ip=`%s`" % (
+            self.name, self.instance_id, ', '.join(self.ips),
+            self.preferred_ip)
 
     def pprint(self):
         """Pretty print information about the node.
@@ -724,5 +1175,5 @@ class Node(object):
 connection IP: %s
 IPs:    %s
 instance id:   %s
-instance flavor: %s""" % (self.name, self.preferred_ip, str.join(', ', self.ips),
+instance flavor: %s""" % (self.name, self.preferred_ip, ', '.join(self.ips),
                           self.instance_id, self.flavor)
@@ -88,6 +88,20 @@ class AbstractCloudProvider:
         """
         pass
 
+    def are_instances_running(self, instance_ids):
+        """Checks which of the given instances are up and running, asking
+        the cloud about all of them at once. Cloud providers which support
+        this should override this method; callers fall back to
+        :py:meth:`is_instance_running` on each instance otherwise.
+
+        :param list instance_ids: instance identifiers
+
+        :return: dict [instance_id] = bool - True if running, False otherwise
+        :raises: NotImplementedError if the cloud provider can only check
+                 one instance at a time
+        """
+        raise NotImplementedError
+
 
 class AbstractSetupProvider:
     """
@@ -52,6 +52,8 @@ class BotoCloudProvider(AbstractCloudProvider):
                                     assigned manually `False`
     """
     __node_start_lock = threading.Lock()  # lock used for node startup
+    __address_lock = threading.Lock()  # lock used for ip allocation
+    __instance_cache_lock = threading.Lock()  # lock used for the cache
 
     def __init__(self, ec2_url, ec2_region, ec2_access_key, ec2_secret_key,
                  storage_path=None, request_floating_ip=False):
@@ -220,15 +222,45 @@ class BotoCloudProvider(AbstractCloudProvider):
         if instance.update() == "running":
             # If the instance is up&running, ensure it has an IP
             # address.
-            if not instance.ip_address and self.request_floating_ip:
-                log.debug("Public ip address has to be assigned through "
-                          "elasticluster.")
-                self._allocate_address(instance)
-                instance.update()
+            self._ensure_ip_address(instance)
             return True
         else:
             return False
 
+    def are_instances_running(self, instance_ids):
+        """Checks which of the given instances are up and running, with a
+        single request to the cloud.
+
+        :param list instance_ids: instance identifiers
+
+        :return: dict [instance_id] = bool - True if running, False otherwise
+        """
+        connection = self._connect()
+        running = dict((instance_id, False) for instance_id in instance_ids)
+        reservations = connection.get_all_instances(instance_ids=instance_ids)
+        for res in reservations:
+            for instance in res.instances:
+                # cache the fresh instance object, so that `get_ips` does
+                # not need to ask the cloud again
+                self._instances[instance.id] = instance
+                if instance.state == "running":
+                    self._ensure_ip_address(instance)
+                    running[instance.id] = True
+        return running
+
+    def _ensure_ip_address(self, instance):
+        """Allocates a public ip address to a running instance which has
+        none, if floating ips have been requested.
+
+        :param instance: instance to check
+        :type instance: py:class:`boto.ec2.instance.Instance`
+        """
+        if not instance.ip_address and self.request_floating_ip:
+            log.debug("Public ip address has to be assigned through "
+                      "elasticluster.")
+            self._allocate_address(instance)
+            instance.update()
+
     def _allocate_address(self, instance):
         """Allocates a free public ip address to the given instance
 
@@ -238,24 +270,27 @@ class BotoCloudProvider(AbstractCloudProvider):
         :return: public ip address
         """
         connection = self._connect()
-        free_addresses = [ ip for ip in connection.get_all_addresses() if not ip.instance_id]
-        if not free_addresses:
+        # nodes may be updated concurrently: do not hand out the same
+        # free address twice
+        with BotoCloudProvider.__address_lock:
+            free_addresses = [ ip for ip in connection.get_all_addresses() if not ip.instance_id]
+            if not free_addresses:
+                try:
+                    address = connection.allocate_address()
+                except Exception, ex:
+                    log.error("Unable to allocate a public IP address to instance `%s`",
+                              instance.id)
+                    return None
+
             try:
-                address = connection.allocate_address()
+                address = free_addresses.pop()
+                instance.use_ip(address)
+                return address.public_ip
             except Exception, ex:
-                log.error("Unable to allocate a public IP address to instance `%s`",
-                          instance.id)
+                log.error("Unable to associate IP address %s to instance `%s`",
+                          address, instance.id)
                 return None
 
-        try:
-            address = free_addresses.pop()
-            instance.use_ip(address)
-            return address.public_ip
-        except Exception, ex:
-            log.error("Unable to associate IP address %s to instance `%s`",
-                      address, instance.id)
-            return None
-
     def _load_instance(self, instance_id):
         """Checks if an instance with the given id is cached. If not it
         will connect to the cloud and put it into the local cache
@@ -271,18 +306,21 @@ class BotoCloudProvider(AbstractCloudProvider):
             return self._instances[instance_id]
 
         # Instance not in the internal dictionary.
-        # First, check the internal cache:
-        if instance_id not in [i.id for i in self._cached_instances]:
-            # Refresh the cache, just in case
-            self._cached_instances = []
-            reservations = connection.get_all_instances()
-            for res in reservations:
-                self._cached_instances.extend(res.instances)
-
-        for inst in self._cached_instances:
-            if inst.id == instance_id:
-                self._instances[instance_id] = inst
-                return inst
+        # First, check the internal cache; instances may be loaded
+        # concurrently, so only one thread at a time refreshes it
+        with BotoCloudProvider.__instance_cache_lock:
+            if instance_id not in [i.id for i in self._cached_instances]:
+                # Refresh the cache, just in case
+                cached_instances = []
+                reservations = connection.get_all_instances()
+                for res in reservations:
+                    cached_instances.extend(res.instances)
+                self._cached_instances = cached_instances
+
+            for inst in self._cached_instances:
+                if inst.id == instance_id:
+                    self._instances[instance_id] = inst
+                    return inst
 
         # If we reached this point, the instance was not found neither
         # in the cache or on the website.
@@ -61,6 +61,7 @@ class OpenStackCloudProvider(AbstractCloudProvider):
     
     """
     __node_start_lock = threading.Lock()  # lock used for node startup
+    __instance_cache_lock = threading.Lock()  # lock used for the cache
 
     def __init__(self, username, password, project_name, auth_url,
                  region_name=None, storage_path=None,
@@ -148,8 +149,9 @@ class OpenStackCloudProvider(AbstractCloudProvider):
 
         :return: tuple (IPs)
         """
-        self._load_instance(instance_id)
-        instance = self._load_instance(instance_id)
+        # the instance has just been reloaded by `is_instance_running` or
+        # `are_instances_running`: do not ask the cloud again
+        instance = self._load_instance(instance_id, force_reload=False)
 
         IPs = sum(instance.networks.values(), [])
 
@@ -177,6 +179,22 @@ class OpenStackCloudProvider(AbstractCloudProvider):
         instance = self._load_instance(instance_id, force_reload=True)
         return instance.status == 'ACTIVE'
 
+    def are_instances_running(self, instance_ids):
+        """Checks which of the given instances are up and running, with a
+        single request to the cloud.
+
+        :param list instance_ids: instance identifiers
+
+        :return: dict [instance_id] = bool - True if running, False otherwise
+        """
+        running = dict((instance_id, False) for instance_id in instance_ids)
+        self._cached_instances = self.client.servers.list()
+        for vm in self._cached_instances:
+            if vm.id in running:
+                self._instances[vm.id] = vm
+                running[vm.id] = vm.status == 'ACTIVE'
+        return running
+
     # Protected methods
 
     def _check_keypair(self, name, public_key_path, private_key_path):
@@ -295,13 +313,12 @@ class OpenStackCloudProvider(AbstractCloudProvider):
                 vm = self.client.servers.get(instance_id)
                 # update cache
                 self._instances[instance_id] = vm
-                # delete internal cache, just in case
-                for i in self._cached_instances:
-                    if i.id == instance_id:
-                        self._cached_instances.remove(i)
-                        self._cached_instances.append(vm)
-                        break
-                    
+                # replace the instance in the internal cache, which
+                # other threads may be reading
+                with OpenStackCloudProvider.__instance_cache_lock:
+                    self._cached_instances = [
+                        vm if i.id == instance_id else i
+                        for i in self._cached_instances]
             except NotFound:
                 raise InstanceError("the given instance `%s` was not found "
                                     "on the coud" % instance_id)
@@ -310,14 +327,15 @@ class OpenStackCloudProvider(AbstractCloudProvider):
 
         # Instance not in the internal dictionary.
         # First, check the internal cache:
-        if instance_id not in [i.id for i in self._cached_instances]:
-            # Refresh the cache, just in case
-            self._cached_instances = self.client.servers.list()
-
-        for inst in self._cached_instances:
-            if inst.id == instance_id:
-                self._instances[instance_id] = inst
-                return inst
+        with OpenStackCloudProvider.__instance_cache_lock:
+            if instance_id not in [i.id for i in self._cached_instances]:
+                # Refresh the cache, just in case
+                self._cached_instances = self.client.servers.list()
+
+            for inst in self._cached_instances:
+                if inst.id == instance_id:
+                    self._instances[instance_id] = inst
+                    return inst
 
         # If we reached this point, the instance was not found neither
         # in the cache or on the website.
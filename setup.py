@@ -72,6 +72,10 @@ if sys.version_info[:2] == (2, 6):
     # cfr. http://code.google.com/p/google-api-python-client/issues/detail?id=299
     required_packages.append('argparse')
 
+if sys.version_info[0] < 3:
+    # `concurrent.futures` is only in the standard library since Python 3.2
+    required_packages.append('futures')
+
 setup(
     name="elasticluster",
     version="1.1-dev",
@@ -19,8 +19,11 @@ __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 
 import os
 import tempfile
+import time
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+
 from mock import MagicMock, PropertyMock
 
 from elasticluster.exceptions import KeypairError, InstanceError, SecurityGroupError, ImageError
@@ -182,6 +185,33 @@ class TestBotoCloudProvider(unittest.TestCase):
         self.assertTrue(provider.is_instance_running(instance_id))
         self.assertFalse(provider.is_instance_running(nr_instance_id))
 
+    def test_are_instances_running(self):
+        """
+        BotoCloudProvider: check if several instances are running at once
+        """
+        instance = MagicMock()
+        type(instance).id = PropertyMock(return_value="test-id")
+        type(instance).state = PropertyMock(return_value="running")
+        nr_instance = MagicMock()
+        type(nr_instance).id = PropertyMock(return_value="test-not-running")
+        type(nr_instance).state = PropertyMock(return_value="pending")
+        res = MagicMock()
+        type(res).instances = PropertyMock(return_value=[instance,
+                                                         nr_instance])
+
+        con = MagicMock()
+        con.get_all_instances.return_value = [res]
+        provider = self._create_provider()
+        provider._connection = con
+
+        ids = ["test-id", "test-not-running"]
+        running = provider.are_instances_running(ids)
+
+        self.assertEqual(running, {"test-id": True,
+                                   "test-not-running": False})
+        con.get_all_instances.assert_called_once_with(instance_ids=ids)
+        self.assertEqual(provider._instances["test-id"], instance)
+
 
 
     def test_load_instance(self):
@@ -225,6 +255,36 @@ class TestBotoCloudProvider(unittest.TestCase):
         # ensure that the instance has been cached
         self.assertEqual(con.get_all_instances.call_count, 0)
 
+    def test_load_instance_concurrently(self):
+        """
+        BotoCloudProvider: load several instances at once
+        """
+        instances = []
+        for n in range(8):
+            instance = MagicMock()
+            type(instance).id = PropertyMock(return_value="test-id%d" % n)
+            instances.append(instance)
+        res = MagicMock()
+        type(res).instances = PropertyMock(return_value=instances)
+
+        def get_all_instances():
+            time.sleep(0.01)
+            return [res]
+
+        con = MagicMock()
+        con.get_all_instances.side_effect = get_all_instances
+        provider = self._create_provider()
+        provider._connection = con
+
+        thread_pool = ThreadPoolExecutor(len(instances))
+        loaded = list(thread_pool.map(provider._load_instance,
+                                      [i.id for i in instances]))
+        thread_pool.shutdown()
+
+        self.assertEqual(loaded, instances)
+        # the first thread refreshed the cache for all the others
+        self.assertEqual(con.get_all_instances.call_count, 1)
+
 
 
     def test_check_security_group(self):
@@ -20,14 +20,19 @@ __author__ = 'Nicolas Baer <nicolas.baer@uzh.ch>'
 import json
 import os
 import shutil
+import socket
 import tempfile
+import threading
 import unittest
 
 from mock import Mock, MagicMock, patch
 
+import elasticluster.cluster
 from elasticluster.conf import Configurator
-from elasticluster.cluster import Cluster, Node
-from elasticluster.exceptions import ClusterError
+from elasticluster.cluster import Cluster, Node, SSHConnectionPool, \
+    _monotonic, _tcp_probe
+from elasticluster.exceptions import ClusterError, InstanceError, \
+    TimeoutError
 from elasticluster.providers.ec2_boto import BotoCloudProvider
 from elasticluster.repository import ClusterRepository
 from tests.test_conf import Configuration
@@ -97,6 +102,35 @@ class TestCluster(unittest.TestCase):
         self.assertEqual(size + 1, len(cluster.nodes['compute']))
         self.assertEqual(cluster.nodes['compute'][3].name, name)
 
+    def test_add_nodes(self):
+        """
+        Add several nodes
+        """
+        cluster = self.get_cluster()
+
+        with patch.object(Cluster, '_check_kind',
+                          wraps=Cluster._check_kind) as check_kind:
+            cluster.add_nodes("compute", 3, 'image_id', 'image_user',
+                              'flavor', 'security_group')
+        check_kind.assert_called_once_with("compute")
+        self.assertEqual([node.name for node in cluster.nodes['compute']],
+                         ['compute001', 'compute002', 'compute003',
+                          'compute004', 'compute005'])
+
+        # new kind of nodes
+        cluster.add_nodes("new-kind", 2, 'image_id', 'image_user',
+                          'flavor', 'security_group')
+        self.assertEqual([node.name for node in cluster.nodes['new-kind']],
+                         ['new-kind001', 'new-kind002'])
+
+        # invalid kind fails before adding anything
+        all_nodes = cluster.get_all_nodes()
+        self.failUnlessRaises(ValueError, cluster.add_nodes, "bad_kind", 2,
+                              'image_id', 'image_user', 'flavor',
+                              'security_group')
+        self.assertFalse("bad_kind" in cluster.nodes)
+        self.assertEqual(cluster.get_all_nodes(), all_nodes)
+
     def test_remove_node(self):
         """
         Remove node
@@ -107,6 +141,18 @@ class TestCluster(unittest.TestCase):
         cluster.remove_node(cluster.nodes['compute'][1])
         self.assertEqual(size - 1, len(cluster.nodes['compute']))
 
+    def test_remove_nodes(self):
+        """
+        Remove several nodes at once
+        """
+        cluster = self.get_cluster(nodes={"compute": 3, "frontend": 1})
+        compute = cluster.nodes['compute'][:]
+
+        cluster._remove_nodes([compute[0], compute[2],
+                               cluster.nodes['frontend'][0]])
+        self.assertEqual(cluster.nodes['compute'], [compute[1]])
+        self.assertEqual(cluster.nodes['frontend'], [])
+
     def test_start(self):
         """
         Start cluster
@@ -115,13 +161,17 @@ class TestCluster(unittest.TestCase):
         cloud_provider.start_instance.return_value = u'test-id'
         cloud_provider.get_ips.return_value = ['127.0.0.1']
         cloud_provider.is_instance_running.return_value = True
+        cloud_provider.are_instances_running.side_effect = \
+            lambda ids: dict((i, True) for i in ids)
 
         cluster = self.get_cluster(cloud_provider=cloud_provider)
         cluster.repository = MagicMock()
 
         ssh_mock = MagicMock()
         with patch('paramiko.SSHClient') as ssh_mock:
-            cluster.start()
+            with patch('elasticluster.cluster._tcp_probe',
+                       return_value=True):
+                cluster.start()
 
         cluster.repository.save_or_update.assert_called_with(cluster)
 
@@ -129,6 +179,167 @@ class TestCluster(unittest.TestCase):
             assert node.instance_id == u'test-id'
             assert node.ips == ['127.0.0.1']
 
+    def test_start_min_nodes(self):
+        """
+        Start cluster with a node which never runs
+        """
+        cloud_provider = MagicMock()
+        cloud_provider.start_instance.side_effect = \
+            lambda *args, **kwargs: u'id-' + kwargs['node_name']
+        cloud_provider.get_ips.return_value = ['127.0.0.1']
+        cloud_provider.are_instances_running.side_effect = \
+            lambda ids: dict((i, i != u'id-compute003') for i in ids)
+
+        def start(min_nodes):
+            cluster = self.get_cluster(cloud_provider=cloud_provider,
+                                       nodes={"compute": 3, "frontend": 1})
+            cluster.repository = MagicMock()
+            cluster.poll_delay_min = 0.05
+            with patch.object(Cluster, 'startup_timeout', 0.2):
+                with patch('paramiko.SSHClient'):
+                    with patch('elasticluster.cluster._tcp_probe',
+                               return_value=True):
+                        try:
+                            cluster.start(min_nodes=min_nodes)
+                        finally:
+                            cluster.repository.save_or_update \
+                                .assert_called_with(cluster)
+            return cluster
+
+        # the node which never runs is stopped and removed
+        cluster = start({"compute": 2})
+        self.assertEqual([node.name for node in cluster.nodes["compute"]],
+                         ['compute001', 'compute002'])
+        self.assertEqual(len(cluster.nodes["frontend"]), 1)
+        cloud_provider.stop_instance.assert_called_once_with(u'id-compute003')
+
+        # the minimum cannot be reached anymore
+        self.failUnlessRaises(ClusterError, start, {"compute": 3})
+
+    def test_wait_for_nodes(self):
+        """
+        Wait for nodes until probe succeeds
+        """
+        cluster = self.get_cluster()
+        nodes = cluster.get_all_nodes()
+        pending = nodes[:]
+        attempts = dict((node.name, 0) for node in nodes)
+
+        def probe(node):
+            attempts[node.name] += 1
+            return attempts[node.name] > 2
+
+        cluster.poll_delay_min = 0
+        thread_pool = cluster._make_thread_pool(len(nodes))
+        cluster._wait_for_nodes(thread_pool, pending, probe,
+                                _monotonic() + 60)
+
+        self.assertEqual(pending, [])
+        for node in nodes:
+            self.assertEqual(attempts[node.name], 3)
+
+        # nodes never ready
+        pending = nodes[:]
+        self.failUnlessRaises(TimeoutError, cluster._wait_for_nodes,
+                              thread_pool, pending, lambda node: False,
+                              _monotonic() + 0.1)
+        self.assertEqual(pending, nodes)
+        thread_pool.shutdown()
+
+    def test_wait_for_nodes_backoff(self):
+        """
+        Wait for nodes without spinning while probes back off
+        """
+        cluster = self.get_cluster()
+        nodes = cluster.get_all_nodes()
+        pending = nodes[:]
+        attempts = dict((node.name, 0) for node in nodes)
+
+        def probe(node):
+            attempts[node.name] += 1
+            return attempts[node.name] > 2
+
+        cluster.poll_delay_min = 0.1
+        cluster.poll_delay_max = 0.2
+        thread_pool = cluster._make_thread_pool(len(nodes))
+        with patch('elasticluster.cluster.wait',
+                   wraps=elasticluster.cluster.wait) as wait:
+            cluster._wait_for_nodes(thread_pool, pending, probe,
+                                    _monotonic() + 60)
+        thread_pool.shutdown()
+
+        self.assertEqual(pending, [])
+        # at most one `wait()` per probe, plus one per schedule wake-up
+        self.assertTrue(wait.call_count <= 2 * sum(attempts.values()))
+
+    def test_wait_for_running_nodes(self):
+        """
+        Wait for nodes to run, checking all of them at once
+        """
+        cloud_provider = MagicMock()
+        states = [False, True]
+        cloud_provider.are_instances_running.side_effect = \
+            lambda ids: dict((i, states.pop(0)) for i in ids)
+        cloud_provider.get_ips.return_value = ['127.0.0.1']
+
+        cluster = self.get_cluster(cloud_provider=cloud_provider,
+                                   nodes={"compute": 1})
+        cluster.poll_delay_min = 0
+        nodes = cluster.get_all_nodes()
+        for node in nodes:
+            node.instance_id = u'test-id'
+
+        pending = nodes[:]
+        thread_pool = cluster._make_thread_pool(len(nodes))
+        cluster._wait_for_running_nodes(thread_pool, pending,
+                                        _monotonic() + 60)
+        thread_pool.shutdown()
+
+        self.assertEqual(pending, [])
+        self.assertEqual(cloud_provider.are_instances_running.call_count, 2)
+        self.assertEqual(nodes[0].ips, ['127.0.0.1'])
+        self.assertFalse(cloud_provider.is_instance_running.called)
+
+        # cloud provider checking one instance at a time
+        cloud_provider.are_instances_running.side_effect = \
+            NotImplementedError
+        cloud_provider.is_instance_running.return_value = True
+
+        pending = nodes[:]
+        thread_pool = cluster._make_thread_pool(len(nodes))
+        cluster._wait_for_running_nodes(thread_pool, pending,
+                                        _monotonic() + 60)
+        thread_pool.shutdown()
+
+        self.assertEqual(pending, [])
+        cloud_provider.is_instance_running.assert_called_once_with(u'test-id')
+
+    def test_refresh_all_nodes_bulk_failure(self):
+        """
+        Check nodes one at a time when checking all of them at once fails
+        """
+        cloud_provider = MagicMock()
+        cloud_provider.are_instances_running.side_effect = \
+            Exception("InvalidInstanceID.NotFound")
+        cloud_provider.is_instance_running.side_effect = \
+            lambda instance_id: instance_id != u'test-id0'
+        cloud_provider.get_ips.return_value = ['127.0.0.1']
+
+        cluster = self.get_cluster(cloud_provider=cloud_provider,
+                                   nodes={"compute": 3})
+        nodes = cluster.get_all_nodes()
+        for n, node in enumerate(nodes):
+            node.instance_id = u'test-id%d' % n
+
+        thread_pool = cluster._make_thread_pool(len(nodes))
+        running = cluster._refresh_all_nodes(thread_pool, nodes)
+        thread_pool.shutdown()
+
+        self.assertEqual(running, nodes[1:])
+        self.assertEqual(cloud_provider.is_instance_running.call_count, 3)
+        for node in nodes[1:]:
+            self.assertEqual(node.ips, ['127.0.0.1'])
+
     def test_check_cluster_size(self):
         nodes = {"compute": 3, "frontend": 1}
         nodes_min = {"compute": 1, "frontend": 3}
@@ -147,6 +358,26 @@ class TestCluster(unittest.TestCase):
         self.failUnlessRaises(ClusterError, cluster._check_cluster_size,
                               min_nodes=nodes_min)
 
+    def test_check_cluster_size_several_groups(self):
+        """
+        Move nodes from several groups to several other groups
+        """
+        cluster = self.get_cluster(nodes={"compute": 3, "frontend": 1})
+        cluster.add_nodes("storage", 3, 'image_id', 'image_user', 'flavor',
+                          'security_group')
+        all_nodes = cluster.get_all_nodes()
+        # `gateway` has no nodes at all yet
+        nodes_min = {"compute": 1, "frontend": 3, "storage": 1,
+                     "gateway": 2}
+
+        cluster._check_cluster_size(nodes_min)
+
+        # both spare groups have to give away all their spare nodes
+        for group, size in nodes_min.items():
+            self.assertEqual(len(cluster.nodes[group]), size)
+        # every node is still in exactly one group
+        self.assertEqual(sorted(cluster.get_all_nodes()), sorted(all_nodes))
+
     def test_get_all_nodes(self):
         """
         Get all nodes
@@ -177,6 +408,35 @@ class TestCluster(unittest.TestCase):
         cloud_provider.stop_instance.assert_called_with(u'test-id')
         cluster.repository.delete.assert_called_once_with(cluster)
 
+    def test_stop_partial_failure(self):
+        """
+        Stop cluster when some instances cannot be stopped
+        """
+        cloud_provider = MagicMock()
+
+        def stop_instance(instance_id):
+            if instance_id == u'test-id0':
+                raise Exception("cannot stop")
+
+        cloud_provider.stop_instance.side_effect = stop_instance
+        cluster = self.get_cluster(cloud_provider=cloud_provider)
+        nodes = cluster.get_all_nodes()
+        for n, node in enumerate(nodes):
+            node.instance_id = u'test-id%d' % n
+        cluster.repository = MagicMock()
+
+        cluster.stop()
+
+        self.assertEqual(cloud_provider.stop_instance.call_count, len(nodes))
+        self.assertEqual(cluster.get_all_nodes(), nodes[:1])
+        self.assertEqual(nodes[0].instance_id, u'test-id0')
+        cluster.repository.save_or_update.assert_called_once_with(cluster)
+        self.assertFalse(cluster.repository.delete.called)
+
+        # forced removal
+        cluster.stop(force=True)
+        cluster.repository.delete.assert_called_once_with(cluster)
+
     def test_get_frontend_node(self):
         """
         Get frontend node
@@ -219,6 +479,38 @@ class TestCluster(unittest.TestCase):
         for node in cluster.get_all_nodes():
             self.assertEqual(node.ips[0], ip)
 
+    def test_update_concurrently(self):
+        """
+        Update nodes concurrently, after loading all the instances at once
+        """
+        storage = MagicMock()
+        cloud_provider = MagicMock()
+        ip = '127.0.0.1'
+        cluster = self.get_cluster(cloud_provider=cloud_provider)
+        cluster.repository = storage
+        nodes = cluster.get_all_nodes()
+        for n, node in enumerate(nodes):
+            node.instance_id = u'test-id%d' % n
+        failing = nodes[0]
+
+        def get_ips(instance_id):
+            # the instances must have been loaded before
+            self.assertEqual(cloud_provider.are_instances_running.call_count,
+                             1)
+            if instance_id == failing.instance_id:
+                raise InstanceError("not found")
+            return [ip]
+
+        cloud_provider.get_ips.side_effect = get_ips
+
+        cluster.update()
+
+        self.assertEqual(cloud_provider.get_ips.call_count, len(nodes))
+        self.assertEqual(failing.ips, [])
+        for node in nodes[1:]:
+            self.assertEqual(node.ips, [ip])
+        storage.save_or_update.assert_called_once_with(cluster)
+
 
 class TestNode(unittest.TestCase):
 
@@ -312,10 +604,132 @@ class TestNode(unittest.TestCase):
         self.assertEqual(node.connect(), None)
 
         # check with mocking the ssh connection
+        node.ips = ['127.0.0.1', '127.0.0.2']
         ssh_mock = MagicMock()
         with patch('elasticluster.cluster.paramiko.SSHClient') as ssh_mock:
-            ssh_mock.connect.return_value = True
-            node.connect()
+            with patch('elasticluster.cluster._tcp_probe') as probe_mock:
+                probe_mock.side_effect = \
+                    lambda ip, timeout: ip == '127.0.0.2'
+                self.assertTrue(node.connect())
+                self.assertEqual(node.preferred_ip, '127.0.0.2')
+                ssh_mock.return_value.connect.assert_called_once_with(
+                    '127.0.0.2', username=self.image_user, allow_agent=True,
+                    look_for_keys=False, key_filename=self.user_key_private,
+                    timeout=Node.connection_timeout)
+
+    def test_connect_other_ips(self):
+        """
+        Close the connections to the IPs which lose the race
+        """
+        node = self.get_node()
+        node.ips = ['127.0.0.1', '127.0.0.2']
+        winner = MagicMock()
+        loser = MagicMock()
+        lost = threading.Event()
+        closed = threading.Event()
+        loser.close.side_effect = lambda: closed.set()
+
+        def connect_to(ip):
+            if ip == '127.0.0.1':
+                return winner
+            lost.wait(5)
+            return loser
+
+        with patch.object(Node, '_connect_to', side_effect=connect_to):
+            self.assertEqual(node.connect(), winner)
+            lost.set()
+            closed.wait(5)
+        self.assertEqual(node.preferred_ip, '127.0.0.1')
+        self.assertTrue(loser.close.called)
+        self.assertFalse(winner.close.called)
+
+        # unexpected errors on one IP do not stop the others
+        node.preferred_ip = None
+
+        def connect_to(ip):
+            if ip == '127.0.0.1':
+                raise RuntimeError("unexpected")
+            return winner
+
+        with patch.object(Node, '_connect_to', side_effect=connect_to):
+            self.assertEqual(node.connect(), winner)
+        self.assertEqual(node.preferred_ip, '127.0.0.2')
+
+    def test_is_ssh_port_open(self):
+        """
+        Check if an ssh server answers on the node
+        """
+        node = self.get_node()
+
+        # check without any ips set on the host
+        self.assertFalse(node.is_ssh_port_open())
+
+        node.ips = ['127.0.0.1', '127.0.0.2']
+        with patch('elasticluster.cluster._tcp_probe') as probe_mock:
+            probe_mock.side_effect = \
+                lambda ip, timeout, banner: ip == '127.0.0.2'
+            self.assertTrue(node.is_ssh_port_open())
+            self.assertEqual(node.preferred_ip, '127.0.0.2')
+            probe_mock.assert_called_with('127.0.0.2',
+                                          timeout=Node.probe_timeout,
+                                          banner=b'SSH-')
+
+    def test_tcp_probe(self):
+        """
+        Read the greeting of a server listening on a real socket
+        """
+        def serve(greeting):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+
+            def answer():
+                conn, _ = server.accept()
+                if greeting:
+                    conn.sendall(greeting)
+                conn.close()
+                server.close()
+
+            thread = threading.Thread(target=answer)
+            thread.start()
+            return server.getsockname()[1], thread
+
+        for greeting, expected in [(b'SSH-2.0-OpenSSH\r\n', True),
+                                   (b'HTTP/1.1 400\r\n', False),
+                                   (b'SS', False),
+                                   (None, False)]:
+            port, thread = serve(greeting)
+            self.assertEqual(_tcp_probe('127.0.0.1', port, timeout=5,
+                                        banner=b'SSH-'), expected)
+            thread.join()
+
+        # plain TCP probe, ignoring the greeting
+        port, thread = serve(None)
+        self.assertTrue(_tcp_probe('127.0.0.1', port, timeout=5))
+        thread.join()
+
+        # nothing listening anymore
+        self.assertFalse(_tcp_probe('127.0.0.1', port, timeout=5,
+                                    banner=b'SSH-'))
+
+    def test_probe_ssh(self):
+        """
+        A node is ready once we can log in, not just when sshd greets
+        """
+        node = self.get_node()
+        node.ips = ['127.0.0.1']
+        ssh = MagicMock()
+        with patch.object(Node, 'is_ssh_port_open', return_value=True):
+            with patch.object(Node, 'connect', return_value=None):
+                self.assertFalse(Cluster._probe_ssh(node))
+            with patch.object(Node, 'connect', return_value=ssh):
+                with patch('elasticluster.cluster.ssh_pool') as pool:
+                    self.assertTrue(Cluster._probe_ssh(node))
+                    pool.release.assert_called_once_with(ssh)
+        with patch.object(Node, 'is_ssh_port_open', return_value=False):
+            with patch.object(Node, 'connect') as connect:
+                self.assertFalse(Cluster._probe_ssh(node))
+                self.assertFalse(connect.called)
 
     def test_update_ips(self):
         """
@@ -336,6 +750,35 @@ class TestNode(unittest.TestCase):
         self.assertEqual(node.ips, ips)
         provider.get_ips.assert_called_once_with(instance_id)
 
+class TestSSHConnectionPool(unittest.TestCase):
+
+    def test_reuse_connection(self):
+        """
+        Reuse released ssh connections
+        """
+        pool = SSHConnectionPool()
+        with patch('elasticluster.cluster.paramiko.SSHClient') as ssh_mock:
+            ssh_mock.side_effect = lambda: MagicMock()
+            with pool.checkout('127.0.0.1', 'user', 'key') as ssh:
+                pass
+            self.assertTrue(pool.get('127.0.0.1', 'user', 'key') is ssh)
+            self.assertFalse(pool.get('127.0.0.2', 'user', 'key') is ssh)
+            self.assertEqual(ssh_mock.call_count, 2)
+
+    def test_drop_inactive_connection(self):
+        """
+        Close released ssh connections which are not active anymore
+        """
+        pool = SSHConnectionPool()
+        with patch('elasticluster.cluster.paramiko.SSHClient') as ssh_mock:
+            ssh_mock.side_effect = lambda: MagicMock()
+            ssh = pool.get('127.0.0.1', 'user', 'key')
+            ssh.get_transport.return_value.is_active.return_value = False
+            pool.release(ssh)
+            ssh.close.assert_called_once_with()
+            self.assertFalse(pool.get('127.0.0.1', 'user', 'key') is ssh)
+
+
 if __name__ == "__main__":
     import nose
     nose.runmodule()